@@ -6,23 +6,37 @@ import requests
 from office365.graph_client import GraphClient
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import BlobServiceClient, BlobType
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import atexit
 from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
 import time
-from azure.core.exceptions import ResourceExistsError, HttpResponseError
+import shutil
+from tempfile import SpooledTemporaryFile
+from azure.core.exceptions import AzureError, ResourceExistsError, ResourceModifiedError, HttpResponseError
 from enum import Enum
 from collections import Counter
-from threading import Lock
+from threading import BoundedSemaphore, Lock
 from datetime import datetime, timedelta, timezone
 from azure.identity import ManagedIdentityCredential, DefaultAzureCredential
 
+# google-re2 matches in linear time; only used when enabled with USE_RE2
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# Load environment variables from the .env file if present
+load_dotenv()
+
 # Configure Logging
-def setup_logging():
+def setup_logging(console_level=logging.INFO):
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)  # Capture all levels
+    listener = None
 
     # Avoid adding handlers multiple times
     if not logger.handlers:
@@ -31,7 +45,7 @@ def setup_logging():
         log_file = os.path.join('/tmp', 'download_upload.log')
         f_handler = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=5)  # File handler with rotation
 
-        c_handler.setLevel(logging.INFO)  # Console handler set to INFO
+        c_handler.setLevel(console_level)  # Console handler defaults to INFO
         f_handler.setLevel(logging.DEBUG)  # File handler set to DEBUG
 
         # Create formatters and add to handlers
@@ -39,17 +53,27 @@ def setup_logging():
         c_handler.setFormatter(formatter)
         f_handler.setFormatter(formatter)
 
-        # Add handlers to the root logger
-        logger.addHandler(c_handler)
-        logger.addHandler(f_handler)
+        # Worker threads only enqueue records; a background listener writes them to the
+        # console and file handlers so the hot path never waits on disk I/O or rotation
+        log_queue = queue.Queue(-1)
+        logger.addHandler(QueueHandler(log_queue))
+        listener = QueueListener(log_queue, c_handler, f_handler, respect_handler_level=True)
+        listener.start()
 
-    return logger
+    return logger, listener
 
-logger = setup_logging()
-logger.debug("Logging is configured and script has started.")
+logger, log_listener = setup_logging(os.getenv("CONSOLE_LOG_LEVEL", "INFO").upper())
 
-# Load environment variables from the .env file if present
-load_dotenv()
+# Flush queued records and stop the listener thread
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+atexit.register(stop_logging)
+
+logger.debug("Logging is configured and script has started.")
 
 # Retrieve values from environment variables
 # TENANT, CLIENT_ID, CLIENT_SECRET, AZURE_CONNECTION_STRING are no longer needed
@@ -58,6 +82,8 @@ AZURE_STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
 FOLDER_PATH = os.getenv("FOLDER_PATH")
 SITE_URL = os.getenv("SITE_URL")
 FILENAME_PATTERNS_JSON = os.getenv("FILENAME_PATTERNS")  # Expecting a JSON string
+MAX_WORKERS = os.getenv("MAX_WORKERS", "16")  # Concurrent download/upload workers
+USE_RE2 = os.getenv("USE_RE2", "false").lower() in ("1", "true", "yes")  # Opt-in: RE2 classes are ASCII-only
 
 # Validate environment variables
 def validate_environment_variables():
@@ -76,6 +102,14 @@ def validate_environment_variables():
 
 validate_environment_variables()
 
+try:
+    MAX_WORKERS = int(MAX_WORKERS)
+    if MAX_WORKERS < 1:
+        raise ValueError("must be at least 1")
+except ValueError as e:
+    logger.critical(f"Invalid MAX_WORKERS value '{MAX_WORKERS}': {e}")
+    raise
+
 # Parse filename_patterns from JSON
 try:
     filename_patterns_data = json.loads(FILENAME_PATTERNS_JSON)
@@ -100,24 +134,115 @@ except Exception as e:
 
 logger.debug(f"Parsed filename_patterns: {filename_patterns}")
 
+# Combine all patterns into a single alternation so each filename needs one match call;
+# the named group that matched maps back to its target folder
+def build_combined_pattern(patterns):
+    if not patterns:
+        return None, {}
+
+    # Numbered group references (backreferences and (?(1)...) conditionals) would point
+    # at the wrong groups once patterns are wrapped
+    if any(re.search(r"\\[1-9]|\(\?\(\d", pattern.pattern) for pattern, _ in patterns):
+        logger.debug("Filename patterns use numbered group references; matching them one by one.")
+        return None, {}
+
+    group_to_folder = {f"_p{i}": target_folder for i, (_, target_folder) in enumerate(patterns)}
+    combined_source = "|".join(f"(?P<_p{i}>{pattern.pattern})" for i, (pattern, _) in enumerate(patterns))
+
+    # RE2 is opt-in: its \w, \d, \s and \b only match ASCII, unlike the re module, so it can
+    # match fewer filenames. Constructs it rejects (e.g. lookarounds) fall back to re.
+    if USE_RE2:
+        if re2 is None:
+            logger.warning("USE_RE2 is set but google-re2 is not installed; using the re module.")
+        else:
+            options = re2.Options()
+            options.case_sensitive = False
+            options.log_errors = False  # Keep RE2 parse errors off stderr; they are logged below
+            try:
+                combined = re2.compile(combined_source, options)
+                logger.debug("Filename patterns compiled with RE2.")
+                return combined, group_to_folder
+            except re2.error as e:
+                logger.info(f"RE2 could not compile filename patterns ({e}); using the re module.")
+
+    try:
+        combined = re.compile(combined_source, re.IGNORECASE)
+    except re.error as e:
+        logger.debug(f"Could not combine filename patterns ({e}); matching them one by one.")
+        return None, {}
+
+    return combined, group_to_folder
+
+def build_filename_matcher(patterns):
+    # Bundle everything match_target_folder needs: the combined pattern's bound match method
+    # (or None), its group -> target folder map and the per-pattern (match, target_folder)
+    # fallback. Binding the match methods once skips attribute resolution per file.
+    combined_pattern, group_to_folder = build_combined_pattern(patterns)
+    combined_match = combined_pattern.match if combined_pattern is not None else None
+    matchers = [(pattern.match, target_folder) for pattern, target_folder in patterns]
+    return combined_match, group_to_folder, matchers
+
+def match_target_folder(name, filename_matcher):
+    combined_match, group_to_folder, matchers = filename_matcher
+    if combined_match is not None:
+        match = combined_match(name)
+        # The wrapping group closes last, so lastgroup names the pattern that matched
+        return group_to_folder[match.lastgroup] if match else None
+
+    for match_fn, target_folder in matchers:
+        if match_fn(name):
+            return target_folder
+    return None
+
+# Folder listings call Graph directly and only request the driveItem fields traversal and download use
+GRAPH_API_URL = "https://graph.microsoft.com/v1.0"
+CHILDREN_SELECT_FIELDS = ["id", "name", "file", "folder", "lastModifiedDateTime", "@microsoft.graph.downloadUrl"]
+CHILDREN_PAGE_SIZE = 999
+
+# Blob metadata key recording the SharePoint lastModifiedDateTime a blob was uploaded from
+SOURCE_MTIME_METADATA_KEY = "source_mtime"
+
+# Block blob upload tuning: files larger than a single put are split into
+# blocks of this size and staged over parallel connections
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
+BLOB_UPLOAD_CONCURRENCY = 8
+
+# Downloads smaller than this are buffered in memory first so the upload gets a seekable stream
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Put Blob From URL errors caused by the source side (Azure cannot read the SharePoint URL,
+# or the file exceeds the single-request copy limit); only these are worth retrying by streaming
+COPY_SOURCE_ERROR_CODES = {"CannotVerifyCopySource", "RequestBodyTooLarge"}
+
 # Define an enumeration for upload statuses
 class UploadStatus(Enum):
     UPLOADED = 'uploaded'
     SKIPPED = 'skipped'
     FAILED = 'failed'
 
+# GraphClient calls acquire_token for every request, so the credential and token are
+# shared across threads and the token is only refreshed shortly before it expires
+graph_credential = None
+graph_token = None
+graph_token_lock = Lock()
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
 def acquire_token():
+    global graph_credential, graph_token
     try:
-        credential = ManagedIdentityCredential()
-        token = credential.get_token("https://graph.microsoft.com/.default")
-        access_token = token.token
-        logger.debug("Successfully acquired access token via Managed Identity.")
+        with graph_token_lock:
+            if graph_token is None or graph_token.expires_on - time.time() < TOKEN_REFRESH_MARGIN_SECONDS:
+                if graph_credential is None:
+                    graph_credential = ManagedIdentityCredential()
+                graph_token = graph_credential.get_token("https://graph.microsoft.com/.default")
+                logger.debug("Successfully acquired access token via Managed Identity.")
+            access_token = graph_token.token
         return {"access_token": access_token}
     except Exception as e:
         logger.exception("Exception occurred while acquiring token via Managed Identity.")
         raise e
 
-def create_session_with_retries(total_retries=3, backoff_factor=1, status_forcelist=(500, 502, 504)):
+def create_session_with_retries(total_retries=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), pool_size=10):
     try:
         session = requests.Session()
         retry = Retry(
@@ -126,9 +251,11 @@ def create_session_with_retries(total_retries=3, backoff_factor=1, status_forcel
             connect=total_retries,
             backoff_factor=backoff_factor,
             status_forcelist=status_forcelist,
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
+            allowed_methods=["HEAD", "GET", "OPTIONS", "PUT", "POST"],
+            respect_retry_after_header=True  # Honour throttling hints on 429/503
         )
-        adapter = HTTPAdapter(max_retries=retry)
+        # Size the connection pool to the worker count so threads never wait on connection checkout
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
         session.mount("https://", adapter)
         session.mount("http://", adapter)
         logger.debug("HTTP session with retry logic created.")
@@ -148,7 +275,9 @@ def connect_to_azure_blob():
         # Create BlobServiceClient with Managed Identity credential
         blob_service_client = BlobServiceClient(
             account_url=blob_service_url,
-            credential=credential
+            credential=credential,
+            max_block_size=BLOB_BLOCK_SIZE,
+            max_single_put_size=BLOB_BLOCK_SIZE
         )
 
         # Get ContainerClient
@@ -166,206 +295,363 @@ def connect_to_azure_blob():
         logger.exception("Failed to connect to Azure Blob Storage.")
         raise e
 
-def upload_stream_to_blob(response_stream, blob_name, container_client, target_folder, overwrite=False, retries=3):
-    blob_path = f"{target_folder}/{blob_name}"
-    blob_client = container_client.get_blob_client(blob_path)
+def list_existing_blobs(container_client, patterns):
+    # Build a blob_path -> (last_modified, source_mtime) map with one listing per target folder,
+    # so traversal does not need a round-trip per file to check existing blobs.
+    # source_mtime is the SharePoint timestamp stored at upload, or None for older blobs.
+    existing_blobs = {}
+    target_folders = {target_folder for _, target_folder in patterns}
 
-    try:
-        if blob_client.exists():
-            if not overwrite:
-                logger.info(f"Blob '{blob_path}' already exists. Skipping upload.")
-                return UploadStatus.SKIPPED  # Indicate that the upload was skipped
-            else:
-                logger.info(f"Blob '{blob_path}' exists and will be overwritten.")
-    except HttpResponseError as e:
-        logger.error(f"Failed to check existence of blob '{blob_path}': {e}")
-        # Decide whether to proceed with upload or abort
-        # For now, we'll proceed with upload
+    for target_folder in target_folders:
+        try:
+            blobs = container_client.list_blobs(name_starts_with=f"{target_folder}/", include=["metadata"])
+            for blob in blobs:
+                source_mtime = (blob.metadata or {}).get(SOURCE_MTIME_METADATA_KEY)
+                try:
+                    source_mtime = datetime.fromisoformat(source_mtime) if source_mtime else None
+                    if source_mtime and source_mtime.tzinfo is None:
+                        source_mtime = source_mtime.replace(tzinfo=timezone.utc)
+                except ValueError:
+                    logger.warning(f"Ignoring invalid {SOURCE_MTIME_METADATA_KEY} metadata on blob '{blob.name}': {source_mtime}")
+                    source_mtime = None
+                existing_blobs[blob.name] = (blob.last_modified, source_mtime)  # Both are timezone-aware
+            logger.debug(f"Listed existing blobs under '{target_folder}/'.")
+        except HttpResponseError as e:
+            logger.error(f"Failed to list blobs under '{target_folder}/': {e}")
+            # Blobs in this folder are treated as missing; uploads run with overwrite disabled
+
+    logger.info(f"Found {len(existing_blobs)} existing blobs in target folders.")
+    return existing_blobs
+
+def upload_stream_to_blob(response_stream, blob_client, overwrite=False, length=None, metadata=None, known_exists=None, if_unmodified_since=None):
+    blob_path = blob_client.blob_name
 
-    for attempt in range(retries):
+    # Callers that already listed the container pass known_exists to save the HEAD request
+    if known_exists is None:
         try:
-            # Upload the stream directly to Azure Blob
-            blob_client.upload_blob(response_stream, overwrite=overwrite)
-            action = "Overwritten" if overwrite else "Uploaded"
-            logger.info(f"{action} blob: {blob_path}")
-            return UploadStatus.UPLOADED  # Indicate a successful upload
-        except ResourceExistsError:
-            logger.error(f"Blob '{blob_path}' already exists and overwrite is disabled.")
-            return UploadStatus.SKIPPED  # Indicate that the upload was skipped due to existing blob
+            known_exists = blob_client.exists()
         except HttpResponseError as e:
-            if e.error_code == "BlobOperationNotSupportedForBlobCreatedBySftp":
-                logger.error(f"Operation not supported for blob '{blob_path}': {e}")
-                return UploadStatus.FAILED  # Indicate a failure that cannot be retried
-            else:
-                logger.error(f"Attempt {attempt + 1} - HTTP error during upload of '{blob_path}': {e}")
-        except Exception as e:
-            logger.error(f"Attempt {attempt + 1} - Unexpected error during upload of '{blob_path}': {e}")
-
-        if attempt < retries - 1:
-            wait_time = 2 ** attempt
-            logger.info(f"Retrying upload in {wait_time} seconds...")
-            time.sleep(wait_time)  # Exponential backoff
+            logger.error("Failed to check existence of blob '%s': %s", blob_path, e)
+            # Decide whether to proceed with upload or abort
+            # For now, we'll proceed with upload
+
+    if known_exists:
+        if not overwrite:
+            logger.info("Blob '%s' already exists. Skipping upload.", blob_path)
+            return UploadStatus.SKIPPED  # Indicate that the upload was skipped
+        else:
+            logger.info("Blob '%s' exists and will be overwritten.", blob_path)
+
+    # Transient failures (429/5xx) are retried by the Azure SDK's own retry policy;
+    # the response stream cannot be replayed here once it has been consumed
+    try:
+        # Upload the stream directly to Azure Blob, staging blocks in parallel
+        blob_client.upload_blob(
+            response_stream,
+            length=length,
+            overwrite=overwrite,
+            metadata=metadata,
+            if_unmodified_since=if_unmodified_since,
+            blob_type=BlobType.BLOCKBLOB,
+            max_concurrency=BLOB_UPLOAD_CONCURRENCY
+        )
+        action = "Overwritten" if overwrite else "Uploaded"
+        logger.info("%s blob: %s", action, blob_path)
+        return UploadStatus.UPLOADED  # Indicate a successful upload
+    except ResourceExistsError:
+        logger.error("Blob '%s' already exists and overwrite is disabled.", blob_path)
+        return UploadStatus.SKIPPED  # Indicate that the upload was skipped due to existing blob
+    except ResourceModifiedError:
+        logger.warning("Blob '%s' changed since it was listed. Skipping upload.", blob_path)
+        return UploadStatus.SKIPPED  # Another writer updated the blob first
+    except HttpResponseError as e:
+        if e.error_code == "BlobOperationNotSupportedForBlobCreatedBySftp":
+            logger.error("Operation not supported for blob '%s': %s", blob_path, e)
         else:
-            logger.error(f"All retry attempts failed for '{blob_path}'.")
+            logger.error("HTTP error during upload of '%s': %s", blob_path, e)
+    except Exception as e:
+        logger.error("Unexpected error during upload of '%s': %s", blob_path, e)
+
+    return UploadStatus.FAILED  # Indicate that the upload failed
 
-    return UploadStatus.FAILED  # Indicate that the upload failed after retries
+def copy_url_to_blob(source_url, blob_client, overwrite=False, metadata=None, if_unmodified_since=None):
+    # Server-side copy via Put Blob From URL; returns None when the caller should fall back to streaming
+    blob_path = blob_client.blob_name
 
-def download_and_upload_pdf(drive_item, container_client, target_folder, session, overwrite=False):
-    download_url = drive_item.properties.get("@microsoft.graph.downloadUrl", None)
+    try:
+        blob_client.upload_blob_from_url(
+            source_url, overwrite=overwrite, metadata=metadata, if_unmodified_since=if_unmodified_since
+        )
+        action = "Overwritten" if overwrite else "Uploaded"
+        logger.info("%s blob from source URL: %s", action, blob_path)
+        return UploadStatus.UPLOADED
+    except ResourceExistsError:
+        logger.error("Blob '%s' already exists and overwrite is disabled.", blob_path)
+        return UploadStatus.SKIPPED
+    except ResourceModifiedError:
+        logger.warning("Blob '%s' changed since it was listed. Skipping upload.", blob_path)
+        return UploadStatus.SKIPPED
+    except HttpResponseError as e:
+        if e.error_code in COPY_SOURCE_ERROR_CODES:
+            logger.warning("Server-side copy failed for '%s', falling back to streaming: %s", blob_path, e)
+            return None
+        # Destination-side errors (permissions, missing container, SFTP-created blob) would fail the same way when streaming
+        logger.error("Server-side copy failed for '%s': %s", blob_path, e)
+        return UploadStatus.FAILED
+    except AzureError as e:
+        # Transport failures (connection reset, DNS, timeout) are not HTTP responses
+        logger.warning("Server-side copy request for '%s' failed, falling back to streaming: %s", blob_path, e)
+        return None
+
+def download_and_upload_pdf(drive_item, blob_client, session, overwrite=False, source_last_modified=None, blob_last_modified=None):
+    download_url = drive_item.get("@microsoft.graph.downloadUrl")
     if download_url:
+        # Record the SharePoint timestamp so the next run can compare against it directly
+        metadata = {SOURCE_MTIME_METADATA_KEY: source_last_modified.isoformat()} if source_last_modified else None
+
+        # The blob listing already tells us whether the blob exists; when overwriting, the
+        # service rejects the write if the blob changed after it was listed
+        known_exists = blob_last_modified is not None
+        if_unmodified_since = blob_last_modified if overwrite else None
+
         try:
-            logger.debug(f"Starting download for: {drive_item.name}")
-            with session.get(download_url, stream=True, timeout=30) as response:
-                response.raise_for_status()
-                # Upload directly to Azure Blob
-                upload_status = upload_stream_to_blob(response.raw, drive_item.name, container_client, target_folder, overwrite=overwrite)
+            # Let Azure fetch the file from SharePoint directly
+            upload_status = copy_url_to_blob(
+                download_url, blob_client, overwrite=overwrite, metadata=metadata, if_unmodified_since=if_unmodified_since
+            )
+
+            if upload_status is None:
+                # Server-side copy was rejected; stream the file through this worker instead
+                logger.debug("Starting download for: %s", drive_item["name"])
+                with session.get(download_url, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    content_length = response.headers.get("Content-Length")
+                    content_length = int(content_length) if content_length else None
+
+                    if content_length is not None and content_length < SPOOL_MAX_SIZE:
+                        # Spool small and medium files so blocks can be read and uploaded independently
+                        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buffer:
+                            shutil.copyfileobj(response.raw, buffer, length=1024 * 1024)
+                            buffered_length = buffer.tell()
+                            buffer.seek(0)
+                            upload_status = upload_stream_to_blob(
+                                buffer, blob_client, overwrite=overwrite, length=buffered_length, metadata=metadata,
+                                known_exists=known_exists, if_unmodified_since=if_unmodified_since
+                            )
+                    else:
+                        # Large or unknown-size files are streamed directly to Azure Blob
+                        upload_status = upload_stream_to_blob(
+                            response.raw, blob_client, overwrite=overwrite, length=content_length, metadata=metadata,
+                            known_exists=known_exists, if_unmodified_since=if_unmodified_since
+                        )
             if upload_status == UploadStatus.UPLOADED:
                 action = "Overwritten and uploaded" if overwrite else "Uploaded"
-                logger.info(f"Successfully {action}: {drive_item.name}")
+                logger.info("Successfully %s: %s", action, drive_item["name"])
                 return UploadStatus.UPLOADED
             elif upload_status == UploadStatus.SKIPPED:
-                logger.info(f"Upload skipped as blob already exists and overwrite was not needed: {drive_item.name}")
+                logger.info("Upload skipped as blob already exists and overwrite was not needed: %s", drive_item["name"])
                 return UploadStatus.SKIPPED
             else:
-                logger.error(f"Failed to upload: {drive_item.name}")
+                logger.error("Failed to upload: %s", drive_item["name"])
                 return UploadStatus.FAILED
         except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to download {drive_item.name}: {e}")
+            logger.error("Failed to download %s: %s", drive_item["name"], e)
             return UploadStatus.FAILED
     else:
-        logger.warning(f"No downloadUrl found for {drive_item.name}, cannot download.")
+        logger.warning("No downloadUrl found for %s, cannot download.", drive_item["name"])
         return UploadStatus.FAILED
 
-def traverse_folders(folder_item, patterns, max_files, session, container_client, executor, futures, pre_skipped, pre_skipped_lock):
-    if max_files <= 0:
-        return 0
+def fetch_children_page(session, url):
+    headers = {"Authorization": f"Bearer {acquire_token()['access_token']}"}
+    response = session.get(url, headers=headers, timeout=30)
+    response.raise_for_status()
+    return response.json()
 
-    folder_name = folder_item.name if folder_item.name else "(No Name)"
-    logger.info(f"Entering folder: {folder_name}")
+def iter_children(session, drive_id, folder_id, folder_name, page_executor):
+    # Yield the children of a folder as plain driveItem dicts. While one page is being
+    # processed the next @odata.nextLink page is already being fetched on page_executor.
+    url = (
+        f"{GRAPH_API_URL}/drives/{drive_id}/items/{folder_id}/children"
+        f"?$select={','.join(CHILDREN_SELECT_FIELDS)}&$top={CHILDREN_PAGE_SIZE}"
+    )
 
     try:
-        children = folder_item.children.get().execute_query()
-        logger.debug(f"Retrieved {len(children)} items from folder: {folder_name}")
+        page = fetch_children_page(session, url)
+        while True:
+            next_url = page.get("@odata.nextLink")
+            next_page = page_executor.submit(fetch_children_page, session, next_url) if next_url else None
+
+            yield from page.get("value", [])
+
+            if next_page is None:
+                return
+            page = next_page.result()
     except Exception as e:
-        logger.error(f"Failed to retrieve children for folder {folder_name}: {e}")
-        return 0
+        logger.error("Failed to retrieve children for folder %s: %s", folder_name, e)
 
-    files_processed = 0
+def list_folder(folder, drive_id, session, page_executor, filename_matcher, existing_blobs):
+    # List a single folder and return its subfolders, the
+    # (item, blob_path, overwrite, source_last_modified, blob_last_modified) uploads
+    # it needs and how many matching files were skipped as already up to date
+    folder_name = folder.get("name") or "(No Name)"
+    logger.info("Entering folder: %s", folder_name)
 
-    for item in children:
-        if files_processed >= max_files:
-            logger.debug("Maximum file download limit reached.")
-            break
+    child_folders = []
+    file_tasks = []
+    files_skipped = 0
 
-        is_file = (item.file is not None)
-        is_folder = (item.folder is not None)
-        child_count = item.folder.childCount if (item.folder and item.folder.childCount is not None) else 0
+    for item in iter_children(session, drive_id, folder["id"], folder_name, page_executor):
+        name = item["name"]
+        is_file = ("file" in item)
+        is_folder = ("folder" in item)
+        child_count = (item["folder"].get("childCount") or 0) if is_folder else 0
 
-        logger.info(f"Found item: {item.name} | IsFile: {is_file}, IsFolder: {is_folder}, ChildCount: {child_count}")
+        logger.debug("Found item: %s | IsFile: %s, IsFolder: %s, ChildCount: %s", name, is_file, is_folder, child_count)
 
         if is_folder and child_count > 0:
-            logger.info(f"Found subfolder: {item.name}")
-            downloaded_in_subfolder = traverse_folders(
-                item, patterns, max_files - files_processed, session, container_client, executor, futures, pre_skipped, pre_skipped_lock
-            )
-            files_processed += downloaded_in_subfolder
+            logger.info("Found subfolder: %s", name)
+            child_folders.append(item)
         elif is_file:
-            for pattern, target_folder in patterns:
-                if pattern.match(item.name):
-                    blob_path = f"{target_folder}/{item.name}"
-                    blob_client = container_client.get_blob_client(blob_path)
+            target_folder = match_target_folder(name, filename_matcher)
+            if target_folder is None:
+                continue  # No pattern matched this file
+
+            blob_path = f"{target_folder}/{name}"
 
-                    # Retrieve the last modified date of the SharePoint file
-                    last_modified = item.properties.get("lastModifiedDateTime", None)
-                    source_last_modified = None  # Initialize source last modified
+            # Retrieve the last modified date of the SharePoint file
+            last_modified = item.get("lastModifiedDateTime")
+            source_last_modified = None  # Initialize source last modified
 
-                    if last_modified:
+            if last_modified:
+                try:
+                    if isinstance(last_modified, str):
+                        # Parse string to datetime; fromisoformat is much cheaper than strptime
                         try:
-                            if isinstance(last_modified, str):
-                                # Parse string to datetime
-                                source_last_modified = datetime.strptime(last_modified, "%Y-%m-%dT%H:%M:%SZ")
-                                source_last_modified = source_last_modified.replace(tzinfo=timezone.utc)
-                            elif isinstance(last_modified, datetime):
-                                # Ensure datetime object is timezone-aware and in UTC
-                                if last_modified.tzinfo is None:
-                                    source_last_modified = last_modified.replace(tzinfo=timezone.utc)
-                                else:
-                                    source_last_modified = last_modified.astimezone(timezone.utc)
+                            if last_modified.endswith("Z"):
+                                source_last_modified = datetime.fromisoformat(last_modified[:-1])
                             else:
-                                logger.warning(f"Unexpected type for lastModifiedDateTime: {type(last_modified)} for {item.name}")
-                                source_last_modified = None
-
-                            logger.debug(f"File '{item.name}' last modified on {source_last_modified} UTC.")
-                        except Exception as e:
-                            logger.error(f"Error processing lastModifiedDateTime for {item.name}: {e}")
-                            source_last_modified = None
+                                source_last_modified = datetime.fromisoformat(last_modified)
+                        except ValueError:
+                            source_last_modified = datetime.strptime(last_modified, "%Y-%m-%dT%H:%M:%SZ")
+                        if source_last_modified.tzinfo is None:
+                            source_last_modified = source_last_modified.replace(tzinfo=timezone.utc)
+                        else:
+                            source_last_modified = source_last_modified.astimezone(timezone.utc)
                     else:
-                        logger.warning(f"No lastModifiedDateTime found for {item.name}. Cannot determine if overwrite is needed.")
+                        logger.warning("Unexpected type for lastModifiedDateTime: %s for %s", type(last_modified), name)
+                        source_last_modified = None
 
-                    try:
-                        blob_exists = blob_client.exists()
-                    except HttpResponseError as e:
-                        logger.error(f"Failed to check existence of blob '{blob_path}': {e}")
-                        # Decide whether to proceed with upload or skip
-                        # For now, we'll proceed with upload
-                        blob_exists = False
+                    logger.debug("File '%s' last modified on %s UTC.", name, source_last_modified)
+                except Exception as e:
+                    logger.error("Error processing lastModifiedDateTime for %s: %s", name, e)
+                    source_last_modified = None
+            else:
+                logger.warning("No lastModifiedDateTime found for %s. Cannot determine if overwrite is needed.", name)
 
-                    overwrite = False  # Default to not overwrite
+            overwrite = False  # Default to not overwrite
 
-                    if blob_exists:
-                        try:
-                            blob_properties = blob_client.get_blob_properties()
-                            blob_last_modified = blob_properties.last_modified  # This is timezone-aware
-                            logger.debug(f"Blob '{blob_path}' last modified on {blob_last_modified} UTC.")
-
-                            if source_last_modified:
-                                if source_last_modified > blob_last_modified:
-                                    overwrite = True
-                                    logger.info(f"Source file '{item.name}' is newer than blob '{blob_path}'. It will be overwritten.")
-                                else:
-                                    logger.info(f"Source file '{item.name}' is not newer than blob '{blob_path}'. Skipping upload.")
-                                    with pre_skipped_lock:
-                                        pre_skipped[0] += 1
-                                    files_processed += 1
-                                    break  # Skip to next item
-                            else:
-                                logger.warning(f"Cannot determine if source file '{item.name}' is newer. Skipping upload.")
-                                with pre_skipped_lock:
-                                    pre_skipped[0] += 1
-                                files_processed += 1
-                                break  # Skip to next item
-                        except Exception as e:
-                            logger.error(f"Error retrieving blob properties for '{blob_path}': {e}")
-                            # Decide whether to proceed with upload or skip
-                            # For now, we'll skip to avoid potential overwrites
-                            with pre_skipped_lock:
-                                pre_skipped[0] += 1
-                            files_processed += 1
-                            break  # Skip to next item
+            synced_last_modified = None
+            blob_last_modified = None
+
+            # Look up the blob in the listing taken before traversal
+            blob_entry = existing_blobs.get(blob_path)
+
+            if blob_entry is not None:
+                blob_last_modified, blob_source_mtime = blob_entry
+                logger.debug("Blob '%s' last modified on %s UTC.", blob_path, blob_last_modified)
+
+                # Prefer the SharePoint timestamp recorded at upload; older blobs only have their own last_modified
+                synced_last_modified = blob_source_mtime or blob_last_modified
+
+                if source_last_modified:
+                    if source_last_modified > synced_last_modified:
+                        overwrite = True
+                        logger.info("Source file '%s' is newer than blob '%s'. It will be overwritten.", name, blob_path)
                     else:
-                        overwrite = False
-                        logger.info(f"Blob '{blob_path}' does not exist. Scheduling upload for: {item.name}")
-
-                    # Schedule the download and upload asynchronously
-                    future = executor.submit(
-                        download_and_upload_pdf,
-                        item,
-                        container_client,
-                        target_folder,
-                        session,
-                        overwrite  # Pass the overwrite flag
-                    )
-                    futures.append(future)
-                    files_processed += 1
-                    logger.debug(f"Scheduled download and upload for: {item.name}")
-                    break  # Stop checking other patterns once matched
+                        logger.info("Source file '%s' is not newer than blob '%s'. Skipping upload.", name, blob_path)
+                        files_skipped += 1
+                        continue  # Skip to next item
+                else:
+                    logger.warning("Cannot determine if source file '%s' is newer. Skipping upload.", name)
+                    files_skipped += 1
+                    continue  # Skip to next item
+            else:
+                logger.info("Blob '%s' does not exist. Scheduling upload for: %s", blob_path, name)
+
+            file_tasks.append((item, blob_path, overwrite, source_last_modified, blob_last_modified))
         else:
             if is_folder:
-                logger.info(f"Empty folder or no childCount: {item.name}, skipping...")
+                logger.info("Empty folder or no childCount: %s, skipping...", name)
             else:
-                logger.info(f"Item {item.name} is neither a file nor a folder with children. Skipping...")
+                logger.info("Item %s is neither a file nor a folder with children. Skipping...", name)
+
+    logger.debug("Listed folder %s: %s subfolders, %s uploads, %s skipped.", folder_name, len(child_folders), len(file_tasks), files_skipped)
+    return child_folders, file_tasks, files_skipped
+
+def traverse_folders(root_folder, drive_id, filename_matcher, max_files, session, container_client, executor, page_executor, futures, existing_blobs):
+    # Breadth-first traversal: each folder listing runs on the executor, and uploads are
+    # scheduled as soon as a listing completes so Graph latency overlaps with transfers.
+    # Returns the number of files scheduled and the number pre-skipped as up to date.
+    if max_files <= 0:
+        return 0, 0
 
-    return files_processed
+    # Bound the uploads waiting in the executor queue so folder listings are not starved
+    upload_slots = BoundedSemaphore(MAX_WORKERS * 4)
+    pending_listings = {
+        executor.submit(list_folder, root_folder, drive_id, session, page_executor, filename_matcher, existing_blobs)
+    }
+    # Both counters are only touched from this thread, so no locking is needed
+    files_scheduled = 0
+    files_skipped = 0
+
+    while pending_listings:
+        done, pending_listings = concurrent.futures.wait(pending_listings, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for listing in done:
+            try:
+                child_folders, file_tasks, folder_skipped = listing.result()
+            except Exception as e:
+                logger.error("Exception while listing folder: %s", e)
+                continue
+
+            files_skipped += folder_skipped
+
+            for item, blob_path, overwrite, source_last_modified, blob_last_modified in file_tasks:
+                if files_scheduled + files_skipped >= max_files:
+                    break
+
+                # Build the blob client once here rather than in each upload helper
+                blob_client = container_client.get_blob_client(blob_path)
+
+                # Schedule the download and upload asynchronously
+                upload_slots.acquire()
+                future = executor.submit(
+                    download_and_upload_pdf,
+                    item,
+                    blob_client,
+                    session,
+                    overwrite,  # Pass the overwrite flag
+                    source_last_modified,
+                    blob_last_modified
+                )
+                future.add_done_callback(lambda _: upload_slots.release())
+                futures.append(future)
+                files_scheduled += 1
+                logger.debug("Scheduled download and upload for: %s", item["name"])
+
+            if files_scheduled + files_skipped >= max_files:
+                logger.debug("Maximum file download limit reached.")
+                for pending in pending_listings:
+                    pending.cancel()
+                pending_listings = set()
+                break
+
+            for child_folder in child_folders:
+                pending_listings.add(
+                    executor.submit(list_folder, child_folder, drive_id, session, page_executor, filename_matcher, existing_blobs)
+                )
+
+    return files_scheduled, files_skipped
 
 def main():
     try:
@@ -388,54 +674,62 @@ def main():
         logger.info(f"Accessing SharePoint folder: {FOLDER_PATH}")
         folder_item = drive.root.get_by_path(FOLDER_PATH).execute_query()
 
+        # Traversal walks the Graph JSON directly from here on
+        root_folder = {"id": folder_item.id, "name": folder_item.name}
+
         # Define maximum number of files to download and upload
         max_files_to_download = 7000
         logger.info(f"Maximum files to download and upload set to: {max_files_to_download}")
 
-        # Create a session with retry logic
-        session = create_session_with_retries()
+        # Create a session with retry logic; listings on the main executor and next-page
+        # prefetches on the page executor share it, so the pool covers both
+        session = create_session_with_retries(pool_size=2 * MAX_WORKERS)
 
-        # Initialize counters for pre-skipped files
-        pre_skipped = [0]  # Using list for mutability
-        pre_skipped_lock = Lock()
+        # Compile the filename patterns into a single matcher for traversal
+        filename_matcher = build_filename_matcher(filename_patterns)
+
+        # List existing blobs once up front instead of checking each file separately
+        existing_blobs = list_existing_blobs(container_client, filename_patterns)
 
         # List to collect all Future objects
         futures = []
 
         # Use ThreadPoolExecutor for concurrent downloads and uploads
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            total_processed = traverse_folders(
-                folder_item,
-                filename_patterns,
+        logger.info(f"Using {MAX_WORKERS} concurrent workers.")
+        # Next-page prefetches get their own pool: a listing blocked on its prefetch must
+        # never wait behind other listings occupying every worker of the main executor
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+                ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="graph-pages") as page_executor:
+            files_scheduled, pre_skipped = traverse_folders(
+                root_folder,
+                drive.id,
+                filename_matcher,
                 max_files_to_download,
                 session,
                 container_client,
                 executor,
+                page_executor,
                 futures,
-                pre_skipped,
-                pre_skipped_lock
+                existing_blobs
             )
-            logger.info(f"Total files scheduled or skipped: {total_processed}")
+            logger.info(f"Total files scheduled or skipped: {files_scheduled + pre_skipped}")
 
             # Shutdown the executor and wait for all tasks to complete
             executor.shutdown(wait=True)
             logger.info("All downloads and uploads completed.")
 
-            # Collect results from all futures
-            results = []
+            # Aggregate the results from all futures as they are collected
+            counts = Counter()
             for future in concurrent.futures.as_completed(futures):
                 try:
                     status = future.result()
-                    results.append(status)
+                    counts[status] += 1
                 except Exception as e:
                     logger.error(f"Exception in future: {e}")
-                    results.append(UploadStatus.FAILED)
-
-            # Aggregate the results using Counter
-            counts = Counter(results)
+                    counts[UploadStatus.FAILED] += 1
 
             # Calculate total skipped files (pre-skipped + upload skipped)
-            total_skipped = pre_skipped[0] + counts.get(UploadStatus.SKIPPED, 0)
+            total_skipped = pre_skipped + counts.get(UploadStatus.SKIPPED, 0)
             total_uploaded = counts.get(UploadStatus.UPLOADED, 0)
             total_failed = counts.get(UploadStatus.FAILED, 0)
 
@@ -449,6 +743,8 @@ def main():
     except Exception as e:
         logger.exception("An unexpected error occurred during the process.")
         print(f"An error occurred: {e}")
+    finally:
+        stop_logging()
 
 if __name__ == "__main__":
     main()